@@ -1,120 +1,267 @@
 import argparse
 import asyncio
 import aiohttp
+import re
+import socket
 import time
 from urllib.parse import urlparse
 import sys
+from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from operator import attrgetter
+from typing import Iterator, List, Dict, Optional, Tuple
+
+try:
+    import aiodns  # c-ares резолвер для aiohttp.AsyncResolver
+except ImportError:
+    aiodns = None
+
+
+@dataclass(slots=True)
+class Stats:
+    """Статистика запросов к одному серверу"""
+    url: str
+    success: int = 0
+    failed: int = 0
+    errors: int = 0
+    min: float = float('inf')
+    max: float = 0.0
+    avg: float = 0.0
+    m2: float = 0.0
+    std_dev: float = 0.0
+
+    def add_time(self, elapsed: float) -> None:
+        """Учитывает время успешного запроса (онлайн-алгоритм Уэлфорда)"""
+        self.success += 1
+        delta = elapsed - self.avg
+        self.avg += delta / self.success
+        self.m2 += delta * (elapsed - self.avg)
+        if elapsed < self.min:
+            self.min = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def finalize(self) -> None:
+        """Вычисляет итоговые значения после всех запросов"""
+        if self.success:
+            self.std_dev = (self.m2 / self.success) ** 0.5
+        else:
+            self.min = self.max = self.avg = self.std_dev = 0
+
+
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
+# Недочитанный остаток тела до этого размера дочитывается, чтобы вернуть соединение в пул
+MAX_DRAIN_BYTES = 64 * 1024
+DRAIN_TIMEOUT = 1.0
+URL_RE = re.compile(r'^https?://[^/?#\s]+\.[^/?#\s]+', re.IGNORECASE)
+
+
+class NoDelayTCPConnector(aiohttp.TCPConnector):
+    """TCPConnector с явным TCP_NODELAY на каждом новом соединении"""
+
+    async def _wrap_create_connection(self, *args, **kwargs):
+        transport, protocol = await super()._wrap_create_connection(*args, **kwargs)
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        return transport, protocol
 
 
 class AsyncServerBenchmark:
-    def __init__(self):
+    def __init__(self, method: str = 'GET', max_body: Optional[int] = None,
+                 warmup: int = 0):
         self.results = []
         self.session: Optional[aiohttp.ClientSession] = None
         self.timeout = aiohttp.ClientTimeout(total=5, connect=3)
-
-    async def test_server(self, url: str, requests_count: int,
-                          global_sem: asyncio.Semaphore,
-                          server_sem: asyncio.Semaphore) -> Dict[str, Any]:
-        """Асинхронно тестирует один сервер с двумя уровнями ограничений"""
-        stats = {
-            'url': url,
-            'success': 0,
-            'failed': 0,
-            'errors': 0,
-            'times': []
-        }
-
-        async with global_sem:
-            async with server_sem:
-                tasks = [self._make_request(url, stats) for _ in range(requests_count)]
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                for r in results:
-                    if isinstance(r, Exception) and not isinstance(r, (KeyboardInterrupt, asyncio.CancelledError)):
-                        stats['errors'] += 1
-
-        if stats['times']:
-            stats['min'] = min(stats['times'])
-            stats['max'] = max(stats['times'])
-            stats['avg'] = sum(stats['times']) / len(stats['times'])
-            variance = sum((t - stats['avg']) ** 2 for t in stats['times']) / len(stats['times'])
-            stats['std_dev'] = variance ** 0.5
-        else:
-            stats['min'] = stats['max'] = stats['avg'] = stats['std_dev'] = 0
-
-        return stats
-
-    async def _make_request(self, url: str, stats: Dict[str, Any]) -> None:
+        self.method = method
+        self.max_body = max_body
+        self.warmup = warmup
+
+    async def _run_pool(self, jobs: Iterator[Tuple[Stats, asyncio.Semaphore]],
+                        workers: int) -> None:
+        """Выполняет задания (stats, семафор хоста) общим пулом из workers воркеров"""
+        async def worker():
+            # Общий итератор: каждое задание достается ровно одному воркеру
+            for stats, host_sem in jobs:
+                async with host_sem:
+                    await self._make_request(stats.url, stats)
+
+        # _make_request сам учитывает ошибки, поэтому TaskGroup не отменяет соседей
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(workers):
+                tg.create_task(worker())
+
+    async def _make_request(self, url: str, stats: Stats) -> None:
         """Выполняет один асинхронный запрос"""
         try:
-            start = time.time()
-            async with self.session.get(url, timeout=self.timeout) as response:
-                await response.read()
-                elapsed = time.time() - start
-
-                if 200 <= response.status < 300:
-                    stats['success'] += 1
-                    stats['times'].append(elapsed)
+            start = time.perf_counter()
+            if self.method == 'HEAD':
+                request = self.session.head(url, timeout=self.timeout, allow_redirects=False)
+            else:
+                request = self.session.get(url, timeout=self.timeout)
+
+            async with request as response:
+                bytes_read = None
+                if self.method != 'HEAD':
+                    if self.max_body is not None:
+                        bytes_read = await self._read_limited(response)
+                    else:
+                        await response.read()
+                elapsed = time.perf_counter() - start
+
+                # HEAD не следует редиректам, поэтому 3xx для него - тоже ответ сервера
+                ok_limit = 400 if self.method == 'HEAD' else 300
+                if 200 <= response.status < ok_limit:
+                    stats.add_time(elapsed)
                 else:
-                    stats['failed'] += 1
+                    stats.failed += 1
+
+                if bytes_read is not None:
+                    await self._release_body(response, bytes_read)
 
         except asyncio.TimeoutError:
-            stats['errors'] += 1
+            stats.errors += 1
         except aiohttp.ClientConnectionError:
-            stats['errors'] += 1
+            stats.errors += 1
         except aiohttp.ClientError:
-            stats['errors'] += 1
+            stats.errors += 1
         except asyncio.CancelledError:
             raise
         except Exception:
-            stats['errors'] += 1
+            stats.errors += 1
+
+    async def _read_limited(self, response: aiohttp.ClientResponse) -> int:
+        """Читает не больше max_body байт тела, возвращает число прочитанных байт"""
+        bytes_read = 0
+        while bytes_read < self.max_body:
+            chunk = await response.content.readany()
+            if not chunk:
+                break
+            bytes_read += len(chunk)
+        return bytes_read
+
+    @staticmethod
+    async def _release_body(response: aiohttp.ClientResponse, bytes_read: int) -> None:
+        """Вне замера дочитывает небольшой остаток тела, чтобы соединение вернулось в пул"""
+        length = response.content_length
+        if length is None or length - bytes_read <= MAX_DRAIN_BYTES:
+            drained = 0
+            try:
+                async with asyncio.timeout(DRAIN_TIMEOUT):
+                    while drained <= MAX_DRAIN_BYTES:
+                        chunk = await response.content.readany()
+                        if not chunk:
+                            response.release()
+                            return
+                        drained += len(chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+
+        # Большой или зависший остаток дешевле оборвать, чем скачивать
+        response.close()
 
     async def run_benchmark(self, servers: List[str], requests_count: int = 1,
                             max_concurrent: int = 10, per_server_limit: int = 3,
-                            global_timeout: int = 300) -> List[Dict[str, Any]]:
+                            global_timeout: int = 300,
+                            use_dns_cache: bool = True,
+                            decompress: bool = False) -> List[Stats]:
         """Запускает асинхронное тестирование для списка серверов"""
-        connector = aiohttp.TCPConnector(
-            limit=100, limit_per_host=per_server_limit,
-            ttl_dns_cache=300, enable_cleanup_closed=True
-        )
-
         timeout = aiohttp.ClientTimeout(total=5, connect=3, sock_read=5)
 
+        # По умолчанию измеряем транспорт без затрат на распаковку
+        headers = {'User-Agent': 'HTTP-Benchmark/1.0'}
+        if not decompress:
+            headers['Accept-Encoding'] = 'identity'
+
+        resolver = None
         try:
+            # Без aiodns остаемся на стандартном ThreadedResolver
+            if aiodns is not None:
+                try:
+                    resolver = aiohttp.AsyncResolver()
+                except Exception as e:
+                    print(f"\nAsyncResolver недоступен ({e}), используется стандартный резолвер",
+                          file=sys.stderr)
+
+            connector = NoDelayTCPConnector(
+                limit=100, limit_per_host=max(per_server_limit, 4),
+                resolver=resolver, use_dns_cache=use_dns_cache,
+                ttl_dns_cache=300, keepalive_timeout=75, force_close=False,
+                enable_cleanup_closed=True
+            )
+
             async with aiohttp.ClientSession(
                     timeout=timeout, connector=connector,
-                    headers={'User-Agent': 'HTTP-Benchmark/1.0'}
+                    headers=headers, auto_decompress=decompress
             ) as session:
                 self.session = session
-                global_semaphore = asyncio.Semaphore(max_concurrent)
 
-                tasks = []
+                # Один семафор на хост: все URL одного хоста делят общий лимит
+                host_semaphores: Dict[str, asyncio.Semaphore] = {}
+                server_sems = []
                 for server in servers:
-                    server_semaphore = asyncio.Semaphore(per_server_limit)
-                    tasks.append(self.test_server(server, requests_count,
-                                                  global_semaphore, server_semaphore))
-
-                self.results = await asyncio.wait_for(
-                    asyncio.gather(*tasks, return_exceptions=True),
-                    timeout=global_timeout
-                )
+                    host = _host_key(server)
+                    if host not in host_semaphores:
+                        host_semaphores[host] = asyncio.Semaphore(per_server_limit)
+                    server_sems.append(host_semaphores[host])
+
+                results = [Stats(server) for server in servers]
+
+                def jobs(count: int, stats_list: List[Stats]):
+                    # По кругу между серверами, чтобы воркеры не копились на одном хосте
+                    pairs = list(zip(stats_list, server_sems))
+                    for _ in range(count):
+                        yield from pairs
+
+                async def run_all():
+                    if self.warmup:
+                        # Прогрев пула соединений: результаты не попадают в статистику
+                        await self._run_pool(jobs(self.warmup, [Stats(s) for s in servers]),
+                                             min(max_concurrent, self.warmup * len(servers)))
+                    await self._run_pool(jobs(requests_count, results),
+                                         min(max_concurrent, requests_count * len(servers)))
+
+                await asyncio.wait_for(run_all(), timeout=global_timeout)
+                for stats in results:
+                    stats.finalize()
+                self.results = results
 
         except asyncio.TimeoutError:
             print("\nПревышено общее время выполнения", file=sys.stderr)
         except Exception as e:
             print(f"\nКритическая ошибка: {e}", file=sys.stderr)
+        finally:
+            # Переданный снаружи резолвер коннектор не закрывает сам
+            if resolver is not None:
+                await resolver.close()
 
         return self.results
 
 
-def validate_url(url: str) -> bool:
-    """Проверяет валидность URL"""
+def _host_key(url: str) -> str:
+    """Хост для общего семафора; неразбираемый URL получает собственный ключ"""
+    try:
+        return urlparse(url).netloc
+    except ValueError:
+        return url
+
+
+def validate_url(url: str, strict: bool = False) -> bool:
+    """Проверяет валидность URL (strict - полным разбором через urlparse)"""
+    if not strict:
+        if URL_RE.match(url) is None:
+            return False
+        # Скобки (IPv6) и не-ASCII хосты urlparse может отвергнуть - проверяем их полным разбором
+        if url.isascii() and '[' not in url and ']' not in url:
+            return True
+
     try:
         result = urlparse(url)
-        return result.scheme in ['http', 'https'] and result.netloc and '.' in result.netloc
-    except (ValueError, AttributeError):
+        return result.scheme in ('http', 'https') and bool(result.netloc) and '.' in result.netloc
+    except (ValueError, AttributeError, TypeError):
         return False
 
 
@@ -135,70 +282,85 @@ def parse_args():
     parser.add_argument('--per-server', type=int, default=3, help='Лимит на сервер')
     parser.add_argument('--timeout', type=int, default=300, help='Общий таймаут (сек)')
     parser.add_argument('--no-color', action='store_true', help='Отключить цветной вывод')
+    parser.add_argument('--method', choices=['GET', 'HEAD'], default='GET',
+                        help='HTTP метод запросов (HEAD не следует редиректам, 3xx считается успехом)')
+    parser.add_argument('--max-body', type=int, help='Читать не больше N байт тела ответа '
+                        '(остаток больше 64 КБ обрывается вместе с соединением)')
+    parser.add_argument('--warmup', type=int, default=0, help='Неучитываемых запросов на сервер перед замером')
+    parser.add_argument('--decompress', action='store_true', help='Запрашивать сжатие и распаковывать ответы')
+    parser.add_argument('--strict-validate', action='store_true', help='Строгая проверка URL через urlparse')
+    parser.add_argument('--no-dns-cache', action='store_true', help='Отключить кэш DNS (для ротируемых DNS)')
 
     return parser.parse_args()
 
 
-def read_urls_from_file(filename: str) -> List[str]:
-    """Читает URL из файла"""
+def iter_urls_from_file(filename: str) -> Iterator[str]:
+    """Построчно читает URL из файла, не загружая его целиком"""
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            urls = [line.strip() for line in f if line.strip()]
-            if not urls:
-                raise ValueError("Файл не содержит URL адресов")
-            return urls
+        with open(filename, 'r', encoding='utf-8', buffering=1 << 20) as f:
+            for line in f:
+                url = line.strip()
+                if url:
+                    yield url
     except (FileNotFoundError, IOError) as e:
         raise ValueError(f"Ошибка чтения файла: {e}")
 
 
-def format_results(results: List[Dict[str, Any]], use_color: bool = True) -> str:
+def format_results(results: List[Stats], use_color: bool = True) -> str:
     """Форматирует результаты для вывода"""
     colors = {
         'reset': '\033[0m', 'bold': '\033[1m', 'green': '\033[92m',
         'yellow': '\033[93m', 'red': '\033[91m', 'blue': '\033[94m', 'cyan': '\033[96m'
     }
-
-    def c(code, text):
-        return f"{colors[code]}{text}{colors['reset']}" if use_color else text
-
-    valid_results = [r for r in results if isinstance(r, dict)]
+    # Коды цветов вычисляются один раз, а не на каждой строке отчета
+    if use_color:
+        RESET, BOLD, GREEN, YELLOW, RED, BLUE, CYAN = (
+            colors[k] for k in ('reset', 'bold', 'green', 'yellow', 'red', 'blue', 'cyan'))
+    else:
+        RESET = BOLD = GREEN = YELLOW = RED = BLUE = CYAN = ''
+
+    valid_results = [r for r in results if isinstance(r, Stats)]
     errors = [str(r) for r in results if isinstance(r, Exception)]
 
     if not valid_results:
-        return f"\n{c('red', 'Нет результатов для отображения')}\n"
-
-    # Заголовок
-    report = [
-        f"\n{c('bold', '=' * 60)}",
-        f"{c('cyan', 'HTTP SERVER BENCHMARK RESULTS')}",
-        f"{c('bold', '=' * 60)}",
-        f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-        ""
-    ]
-
-    # Ошибки (если есть)
-    if errors:
-        report.append(f"{c('yellow', f'Ошибки: {len(errors)}')}")
-        for e in errors[:2]:
-            report.append(f"\t{c('red', '•')} {e[:100]}...")
-        if len(errors) > 2:
-            report.append(f"\t{c('yellow', f'... и еще {len(errors) - 2}')}")
-        report.append("")
-
-    # Результаты
-    for i, res in enumerate(sorted(valid_results, key=lambda x: x['avg']), 1):
-        total = res['success'] + res['failed'] + res['errors']
-        rate = (res['success'] / total * 100) if total > 0 else 0
-        color = 'green' if rate == 100 else 'yellow' if rate >= 80 else 'red'
-
-        report.append(f"{c('bold', f'#{i}')} {c('blue', res['url'])}")
-        report.append(f"  {c('bold', '├─')} {c(color, str(res['success']))}/{total} ({rate:.1f}%) | "
-                      f"{res['failed']} | {res['errors']}")
-        report.append(f"  {c('bold', '└─')} min={res['min']:.3f}s max={res['max']:.3f}s "
-                      f"avg={c('cyan', f'{res["avg"]:.3f}')}s σ={res['std_dev']:.3f}s")
-        report.append("")
-
-    return "\n".join(report)
+        return f"\n{RED}Нет результатов для отображения{RESET}\n"
+
+    # Шаблон строки результата с уже подставленными цветами
+    row_template = (
+        f"{BOLD}#{{i}}{RESET} {BLUE}{{res.url}}{RESET}\n"
+        f"  {BOLD}├─{RESET} {{color}}{{res.success}}{RESET}/{{total}} ({{rate:.1f}}%) | "
+        f"{{res.failed}} | {{res.errors}}\n"
+        f"  {BOLD}└─{RESET} min={{res.min:.3f}}s max={{res.max:.3f}}s "
+        f"avg={CYAN}{{res.avg:.3f}}{RESET}s σ={{res.std_dev:.3f}}s\n"
+    )
+
+    def lines():
+        # Заголовок
+        yield f"\n{BOLD}{'=' * 60}{RESET}"
+        yield f"{CYAN}HTTP SERVER BENCHMARK RESULTS{RESET}"
+        yield f"{BOLD}{'=' * 60}{RESET}"
+        yield datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        yield ""
+
+        # Ошибки (если есть)
+        if errors:
+            yield f"{YELLOW}Ошибки: {len(errors)}{RESET}"
+            for e in errors[:2]:
+                yield f"\t{RED}•{RESET} {e[:100]}..."
+            if len(errors) > 2:
+                yield f"\t{YELLOW}... и еще {len(errors) - 2}{RESET}"
+            yield ""
+
+        # Результаты
+        for i, res in enumerate(sorted(valid_results, key=attrgetter('avg')), 1):
+            total = res.success + res.failed + res.errors
+            rate = (res.success / total * 100) if total > 0 else 0
+            color = GREEN if rate == 100 else YELLOW if rate >= 80 else RED
+
+            yield row_template.format_map(
+                {'i': i, 'res': res, 'color': color, 'total': total, 'rate': rate})
+
+    return "\n".join(lines())
 
 
 async def main_async():
@@ -206,16 +368,22 @@ async def main_async():
     try:
         args = parse_args()
 
-        # Получение URL
-        urls = [u.strip() for u in args.hosts.split(',') if u.strip()] if args.hosts else read_urls_from_file(args.file)
-
-        if not urls:
+        # Получение и валидация URL за один проход
+        raw_urls = args.hosts.split(',') if args.hosts else iter_urls_from_file(args.file)
+        valid_urls = []
+        invalid_count = 0
+        for url in raw_urls:
+            url = url.strip()
+            if not url:
+                continue
+            if validate_url(url, args.strict_validate):
+                valid_urls.append(url)
+            else:
+                invalid_count += 1
+
+        if not valid_urls and not invalid_count:
             raise ValueError("Нет URL для тестирования")
 
-        # Валидация
-        valid_urls = [u for u in urls if validate_url(u)]
-        invalid_count = len(urls) - len(valid_urls)
-
         if invalid_count:
             print(f"Пропущено {invalid_count} невалидных URL", file=sys.stderr)
 
@@ -225,34 +393,42 @@ async def main_async():
         # Проверка параметров
         if args.count < 1 or args.parallel < 1 or args.per_server < 1:
             raise ValueError("Параметры count, parallel и per-server должны быть ≥ 1")
+        if args.max_body is not None and args.max_body < 0:
+            raise ValueError("Параметр max-body должен быть ≥ 0")
+        if args.warmup < 0:
+            raise ValueError("Параметр warmup должен быть ≥ 0")
 
         # Заглушка прогресса
         print(f"\nТестирование {len(valid_urls)} серверов ({args.count} запросов на сервер) | "
               f"⚡ {args.parallel} параллельных | {args.timeout}с ... ", end='', flush=True)
 
         # Запуск
-        start_time = time.time()
-        benchmark = AsyncServerBenchmark()
+        start_time = time.perf_counter()
+        benchmark = AsyncServerBenchmark(args.method, args.max_body, args.warmup)
         results = await benchmark.run_benchmark(
-            valid_urls, args.count, args.parallel, args.per_server, args.timeout
+            valid_urls, args.count, args.parallel, args.per_server, args.timeout,
+            use_dns_cache=not args.no_dns_cache, decompress=args.decompress
         )
-        elapsed = time.time() - start_time
+        elapsed = time.perf_counter() - start_time
 
         print(f"{elapsed:.1f}с")
 
         # Форматирование результатов
-        report = format_results(results, not args.no_color)
-        report += f"\n{'─' * 60}\nВсего: {elapsed:.2f}с | "
-        report += f"{sum(1 for r in results if isinstance(r, dict))}/{len(valid_urls)} серверов\n"
+        body = format_results(results, not args.no_color)
+        report = body + f"\n{'─' * 60}\nВсего: {elapsed:.2f}с | "
+        report += f"{sum(1 for r in results if isinstance(r, Stats))}/{len(valid_urls)} серверов\n"
 
         # Вывод/сохранение
         if args.output:
-            clean_report = format_results(results, False) + f"\n{'─' * 60}\nTotal: {elapsed:.2f}s"
-            with open(args.output, 'w', encoding='utf-8') as f:
+            # Повторный рендер не нужен: достаточно убрать ANSI-коды
+            clean_report = ANSI_RE.sub('', body) + f"\n{'─' * 60}\nTotal: {elapsed:.2f}s"
+            with open(args.output, 'w', encoding='utf-8', buffering=1 << 20) as f:
                 f.write(clean_report)
             print(f"Результаты сохранены в {args.output}")
 
-        print(report)
+        # Весь отчет одной записью вместо построчного print
+        sys.stdout.write(report + '\n')
+        sys.stdout.flush()
 
     except (KeyboardInterrupt, asyncio.CancelledError):
         print("\n\nПрервано пользователем")
@@ -264,8 +440,18 @@ async def main_async():
 
 def main():
     """Точка входа"""
+    loop_factory = None
+    if sys.platform != 'win32':
+        try:
+            import uvloop
+            loop_factory = uvloop.new_event_loop
+        except ImportError:
+            pass
+
     try:
-        asyncio.run(main_async())
+        # Runner с loop_factory не меняет глобальную политику event loop
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(main_async())
     except KeyboardInterrupt:
         pass
 